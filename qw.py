@@ -1,21 +1,134 @@
 #!/usr/bin/env python3
 import argparse
+import atexit
+import concurrent.futures
+import functools
+import http.client
 import json
+import os
+import re
 import shutil
+import socket
 import subprocess
 import sys
-import urllib.request
-from pathlib import Path
+import urllib.parse
+
+try:
+    import orjson
+except ImportError:  # optional; stdlib json is the fallback
+    orjson = None
 
 DEFAULT_MODEL = "qwen2.5-coder:0.5b-instruct"
 API_URL = "http://127.0.0.1:11434/api/generate"
+_API = urllib.parse.urlsplit(API_URL)
+_HEADERS = {"Content-Type": "application/json", "Connection": "keep-alive"}
+_CONN = None
+_LOG_FH = {}
+
+
+if orjson is not None:
+    _loads = orjson.loads
+
+    def _dumps(obj):
+        try:
+            return orjson.dumps(obj)
+        except orjson.JSONEncodeError:
+            # lone surrogates (undecodable argv bytes); json escapes them
+            return json.dumps(obj, separators=(",", ":")).encode()
+
+else:
+    _loads = json.loads
+
+    # compact separators so output matches orjson byte for byte
+    def _dumps(obj):
+        try:
+            return json.dumps(obj, ensure_ascii=False, separators=(",", ":")).encode()
+        except UnicodeEncodeError:
+            return json.dumps(obj, separators=(",", ":")).encode()
+
+
+# Fast path for plain stream frames: pull the "response" string straight out
+# of the raw bytes; frames carrying "done" or "error" still get a full parse.
+_RESP_RE = re.compile(rb'"response":"((?:[^"\\]|\\.)*)"')
+
+
+def _fast_response(line):
+    m = _RESP_RE.search(line)
+    if m is None:
+        return None
+    raw = m.group(1)
+    if b"\\" not in raw:
+        return raw.decode("utf-8")
+    return _loads(b'"' + raw + b'"')
+
+
+def _iter_lines(resp, bufsize=65536):
+    # Read in large chunks and split frames ourselves; iterating the response
+    # directly goes through many small buffered reads. HTTPResponse.read1()
+    # returns after at most one transfer chunk, so frames arrive as sent.
+    buf = b""
+    while True:
+        chunk = resp.read1(bufsize)
+        if not chunk:
+            break
+        buf += chunk
+        start = 0
+        while (nl := buf.find(b"\n", start)) != -1:
+            yield buf[start:nl]
+            start = nl + 1
+        buf = buf[start:]
+    if buf:
+        yield buf
+
+
+class _NoDelayHTTPConnection(http.client.HTTPConnection):
+    # TCP_NODELAY only affects what we send: http.client writes the request
+    # headers and body in separate send() calls, and Nagle could hold the body
+    # back until the headers are acked. It does not change how fast Ollama's
+    # stream frames reach us.
+    def connect(self):
+        super().connect()
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+
+def _get_conn():
+    # One keep-alive connection to Ollama, reused across requests.
+    global _CONN
+    if _CONN is None:
+        _CONN = _NoDelayHTTPConnection(_API.hostname, _API.port, timeout=300)
+    return _CONN
+
+
+def _drop_conn():
+    global _CONN
+    if _CONN is not None:
+        _CONN.close()
+        _CONN = None
+
+
+def _write_out(text):
+    # Streamed output; a closed stdout pipe (e.g. `qw ... | head`) is not a
+    # Qwen failure, so exit quietly instead of reporting one.
+    try:
+        sys.stdout.write(text)
+        sys.stdout.flush()
+    except BrokenPipeError:
+        devnull = os.open(os.devnull, os.O_WRONLY)
+        os.dup2(devnull, sys.stdout.fileno())
+        sys.exit(1)
+
+
+def _text(b):
+    return b.decode("utf-8", "replace")
 
 
-def run(cmd, stdin_text=None):
+def run(cmd, stdin_text=None, keep_stdin=False):
+    # Output is captured as bytes; callers decode with _text() where needed.
+    # Without stdin_text the child gets /dev/null unless keep_stdin is set.
     return subprocess.run(
         cmd,
-        input=stdin_text,
-        text=True,
+        input=stdin_text.encode() if stdin_text is not None else None,
+        stdin=None if stdin_text is not None or keep_stdin else subprocess.DEVNULL,
         capture_output=True,
         check=False,
     )
@@ -24,15 +137,22 @@ def run(cmd, stdin_text=None):
 def get_prompt(args):
     if args.prompt:
         return " ".join(args.prompt).strip()
-    data = sys.stdin.read()
-    if data.strip():
-        return data.strip()
+    data = sys.stdin.buffer.read().decode("utf-8", errors="replace").strip()
+    if data:
+        return data
     print("qw: provide a prompt as args or stdin", file=sys.stderr)
     sys.exit(1)
 
 
+@functools.lru_cache(maxsize=8)
+def _which(b):
+    return shutil.which(b)
+
+
 def ensure_bins(bins):
-    missing = [b for b in bins if shutil.which(b) is None]
+    if not bins:
+        return
+    missing = [b for b in bins if _which(b) is None]
     if missing:
         print("qw: missing required command(s): " + ", ".join(missing), file=sys.stderr)
         sys.exit(1)
@@ -41,18 +161,41 @@ def ensure_bins(bins):
 def load_sys_prompt(path_str):
     if not path_str:
         return ""
-    path = Path(path_str).expanduser()
+    p = os.path.expanduser(path_str)
     try:
-        return path.read_text()
+        with open(p, "r", encoding="utf-8") as f:
+            return f.read()
     except Exception as e:
         print(f"qw: failed to read system prompt file: {e}", file=sys.stderr)
         sys.exit(1)
 
 
+def _model_present(model):
+    # Short-lived connection so a hung Ollama can't stall the check for long.
+    conn = _NoDelayHTTPConnection(_API.hostname, _API.port, timeout=5)
+    try:
+        conn.request(
+            "POST",
+            "/api/show",
+            body=_dumps({"model": model}),
+            headers=_HEADERS,
+        )
+        resp = conn.getresponse()
+        resp.read()
+        return resp.status == 200
+    except Exception:
+        return False
+    finally:
+        conn.close()
+
+
 def maybe_auto_pull(model):
+    # Skip the registry round trip when Ollama already has the model.
+    if _model_present(model):
+        return
     res = run(["ollama", "pull", model])
     if res.returncode != 0:
-        print(res.stderr or res.stdout or "qw: ollama pull failed", file=sys.stderr)
+        print(_text(res.stderr or res.stdout) or "qw: ollama pull failed", file=sys.stderr)
         sys.exit(res.returncode or 1)
 
 
@@ -65,68 +208,140 @@ def run_qwen(
     system="",
     seed=None,
     stop=None,
+    stream_out=False,
 ):
-    payload = {
-        "model": model,
-        "prompt": prompt,
-        "stream": True,
-    }
-    if system:
-        payload["system"] = system
-    if temp is not None:
-        payload["temperature"] = temp
-    if top_p is not None:
-        payload["top_p"] = top_p
-    if max_tokens is not None:
-        payload["max_tokens"] = max_tokens
-    if seed is not None:
-        payload["seed"] = seed
-    if stop:
-        payload["stop"] = stop
-
-    data = json.dumps(payload).encode()
-    req = urllib.request.Request(API_URL, data=data, headers={"Content-Type": "application/json"})
+    if not (system or stop or seed is not None or top_p is not None or max_tokens is not None):
+        # Common case: splice the body together without building a payload dict.
+        data = (
+            b'{"model":'
+            + _dumps(model)
+            + b',"prompt":'
+            + _dumps(prompt)
+            + b',"stream":true'
+            + (b',"temperature":' + _dumps(temp) if temp is not None else b"")
+            + b"}"
+        )
+    else:
+        payload = {
+            "model": model,
+            "prompt": prompt,
+            "stream": True,
+        }
+        if system:
+            payload["system"] = system
+        if temp is not None:
+            payload["temperature"] = temp
+        if top_p is not None:
+            payload["top_p"] = top_p
+        if max_tokens is not None:
+            payload["max_tokens"] = max_tokens
+        if seed is not None:
+            payload["seed"] = seed
+        if stop:
+            payload["stop"] = stop
+        data = _dumps(payload)
     chunks = []
+    held = ""
+    wrote = False
+
+    def emit(text):
+        # With stream_out, write fragments as they arrive instead of collecting
+        # them; surrounding whitespace is trimmed as .strip() would.
+        nonlocal held, wrote
+        if not stream_out:
+            chunks.append(text)
+            return
+        text = held + text
+        out = text.rstrip()
+        held = text[len(out):]
+        if not wrote:
+            out = out.lstrip()
+        if out:
+            _write_out(out)
+            wrote = True
+
     try:
-        with urllib.request.urlopen(req, timeout=300) as resp:
-            for line in resp:
-                if not line.strip():
+        conn = _get_conn()
+        conn.request(
+            "POST",
+            _API.path,
+            body=data,
+            headers=_HEADERS,
+        )
+        resp = conn.getresponse()
+        if resp.status != 200:
+            body = resp.read()
+            try:
+                detail = _loads(body)["error"]
+            except Exception:
+                detail = resp.reason
+            raise RuntimeError(f"HTTP Error {resp.status}: {detail}")
+        for line in _iter_lines(resp):
+            if not line or line.isspace():
+                continue
+            has_done = b'"done":true' in line
+            has_err = b'"error"' in line
+            if not (has_done or has_err):
+                text = _fast_response(line)
+                if text is not None:
+                    emit(text)
                     continue
-                msg = json.loads(line)
-                if msg.get("error"):
-                    raise RuntimeError(msg["error"])
-                if "response" in msg:
-                    chunks.append(msg["response"])
-                if msg.get("done"):
-                    break
+            msg = _loads(line)
+            if msg.get("error"):
+                raise RuntimeError(msg["error"])
+            if "response" in msg:
+                emit(msg["response"])
+            if msg.get("done"):
+                break
+        # drain the rest of the response so the connection can be reused
+        resp.read()
     except Exception as e:
+        _drop_conn()
+        if wrote:
+            _write_out("\n")
         print(f"qw: qwen request failed: {e}", file=sys.stderr)
         sys.exit(1)
+    if stream_out:
+        _write_out("\n")
     return "".join(chunks).strip()
 
 
+def _close_logs():
+    for fh in _LOG_FH.values():
+        fh.close()
+    _LOG_FH.clear()
+
+
+atexit.register(_close_logs)
+
+
 def log_run(path_str, prompt, qwen_reply, codex_reply, claude_reply):
-    path = Path(path_str).expanduser()
+    p = os.path.expanduser(path_str)
     try:
-        path.parent.mkdir(parents=True, exist_ok=True)
+        # Keep one line-buffered handle per log path for the life of the process.
+        fh = _LOG_FH.get(p)
+        if fh is None:
+            os.makedirs(os.path.dirname(p) or ".", exist_ok=True)
+            fh = open(p, "a", encoding="utf-8", buffering=1)
+            _LOG_FH[p] = fh
         record = {
             "prompt": prompt,
             "qwen": qwen_reply,
             "codex": codex_reply,
             "claude": claude_reply,
         }
-        with path.open("a", encoding="utf-8") as f:
-            f.write(json.dumps(record, ensure_ascii=False) + "\n")
+        fh.write(json.dumps(record, ensure_ascii=False) + "\n")
     except Exception as e:
         print(f"qw: failed to log run: {e}", file=sys.stderr)
 
 
 def run_shell(cmd):
-    res = run(["/bin/sh", "-c", cmd])
+    # --execute commands may need the terminal (read, password prompts)
+    res = run(["/bin/sh", "-c", cmd], keep_stdin=True)
     if res.stdout:
-        print("\n--- execute stdout ---\n" + res.stdout.strip())
+        print("\n--- execute stdout ---\n" + _text(res.stdout).strip())
     if res.stderr:
-        print("\n--- execute stderr ---\n" + res.stderr.strip(), file=sys.stderr)
+        print("\n--- execute stderr ---\n" + _text(res.stderr).strip(), file=sys.stderr)
     if res.returncode != 0:
         sys.exit(res.returncode)
 
@@ -166,6 +381,9 @@ def main():
     if args.auto_pull:
         maybe_auto_pull(args.model)
 
+    # Nothing downstream needs the full reply: print it as it is generated.
+    stream_out = not (args.codex or args.claude or args.json or args.log_file or args.execute or args.quiet)
+
     qwen_reply = run_qwen(
         prompt,
         args.model,
@@ -175,31 +393,43 @@ def main():
         system=system_prompt,
         seed=args.seed,
         stop=args.stop,
+        stream_out=stream_out,
     )
 
     codex_reply = None
     claude_reply = None
 
-    if not args.quiet and not args.json:
+    if not (args.quiet or args.json or stream_out):
         print(qwen_reply)
 
+    tasks = {}
+    if args.codex or args.claude:
+        # codex and claude are independent; run them side by side. Both always
+        # run to completion, so a codex failure is reported only once claude
+        # has also finished (up to --timeout), and claude's output is discarded.
+        with concurrent.futures.ThreadPoolExecutor(max_workers=2) as ex:
+            if args.codex:
+                tasks["codex"] = ex.submit(run, ["codex", "exec", "--timeout", args.timeout, qwen_reply])
+            if args.claude:
+                tasks["claude"] = ex.submit(run, ["claude", "-t", args.timeout, qwen_reply])
+
     if args.codex:
-        c = run(["codex", "exec", "--timeout", args.timeout, qwen_reply])
+        c = tasks["codex"].result()
         if c.returncode != 0:
-            print(c.stderr or c.stdout or "qw: codex failed", file=sys.stderr)
+            print(_text(c.stderr or c.stdout) or "qw: codex failed", file=sys.stderr)
             sys.exit(c.returncode)
-        codex_reply = c.stdout.strip()
+        codex_reply = _text(c.stdout).strip()
         if not args.json:
-            print("\n--- codex ---\n" + codex_reply)
+            sys.stdout.writelines(("\n--- codex ---\n", codex_reply, "\n"))
 
     if args.claude:
-        cl = run(["claude", "-t", args.timeout, qwen_reply])
+        cl = tasks["claude"].result()
         if cl.returncode != 0:
-            print(cl.stderr or cl.stdout or "qw: claude failed", file=sys.stderr)
+            print(_text(cl.stderr or cl.stdout) or "qw: claude failed", file=sys.stderr)
             sys.exit(cl.returncode)
-        claude_reply = cl.stdout.strip()
+        claude_reply = _text(cl.stdout).strip()
         if not args.json:
-            print("\n--- claude ---\n" + claude_reply)
+            sys.stdout.writelines(("\n--- claude ---\n", claude_reply, "\n"))
 
     if args.json:
         out = {"qwen": qwen_reply}
@@ -207,7 +437,7 @@ def main():
             out["codex"] = codex_reply
         if claude_reply is not None:
             out["claude"] = claude_reply
-        print(json.dumps(out, ensure_ascii=False))
+        print(_dumps(out).decode())
 
     if args.log_file:
         log_run(args.log_file, prompt, qwen_reply, codex_reply, claude_reply)